@@ -1,77 +1,110 @@
 import os
+import asyncio
+import atexit
+import base64
+import functools
+import hashlib
+import hmac
+import json
 import logging
+import queue
+import threading
+import uuid
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+import tiktoken
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException, status
-from linebot.v3 import WebhookHandler
+from fastapi.responses import ORJSONResponse
 from linebot.v3.messaging import (
     Configuration,
-    ApiClient,
-    MessagingApi,
+    AsyncApiClient,
+    AsyncMessagingApi,
     ReplyMessageRequest,
-    MessagingApiBlob,
+    ShowLoadingAnimationRequest,
     TextMessage
 )
-from linebot.v3.messaging.models import (
-    RichMenuRequest,
-    RichMenuSize,
-    RichMenuArea,
-    RichMenuBounds,
-    MessageAction,
-)
 from linebot.v3.webhooks import (
+    Event,
     MessageEvent,
     TextMessageContent,
     FollowEvent,
     UnfollowEvent,
+    UserSource,
 )
-from linebot.v3.exceptions import InvalidSignatureError
 from google.cloud import firestore
 from google.auth.exceptions import DefaultCredentialsError
-from openai import OpenAI, AuthenticationError, RateLimitError, APIError
+from google.api_core.exceptions import NotFound
+from openai import AsyncOpenAI, AuthenticationError, RateLimitError, APIError
 import uvicorn
 import os
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# ログ設定
+def configure_logging():
+    """ログはキューに積むだけにし、標準出力への書き込みは別スレッドで行う（イベントループをブロックしない）"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+configure_logging()
+
 # 環境変数から設定値を取得
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 20))  # OpenAI APIへの同時リクエスト数の上限
+OPENAI_MAX_RETRIES = 3  # OpenAI API呼び出しの再試行回数
+LINE_CONNECTION_POOL_MAXSIZE = int(os.getenv('LINE_CONNECTION_POOL_MAXSIZE', 64))  # LINE APIへの同時接続数の上限
+WARM_UP_TIMEOUT = 10  # 起動時の接続ウォームアップの待ち時間の上限（秒）
 
 # グローバル変数・クライアント初期化
-app = FastAPI()
-handler = None
-line_bot_api = None
+async_line_bot_api = None
 openai_client = None
 db = None
 
+# LINE APIクライアントの設定を作成する関数
+def create_line_configuration() -> Configuration:
+    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+    # 同時に処理するイベント数に合わせて接続プールを広げ、TLSハンドシェイクを使い回す
+    configuration.connection_pool_maxsize = LINE_CONNECTION_POOL_MAXSIZE
+    return configuration
+
 # 初期化処理
 def initialize_clients():
     """各APIクライアントを初期化する"""
-    global handler, line_bot_api, openai_client, db
+    global openai_client, db
 
-    # LINE Bot SDKの初期化
+    # LINE Bot SDKの設定確認
+    # （クライアントはイベントループ上で生成する必要があるため lifespan 内で初期化する）
     if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
         raise ValueError("LINE Bot credentials missing.")
-    try:
-        configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-        api_client = ApiClient(configuration)
-        line_bot_api = MessagingApi(api_client)
-        handler = WebhookHandler(LINE_CHANNEL_SECRET)
-    except Exception as e:
-        raise
 
     # OpenAIクライアントの初期化
     if not OPENAI_API_KEY:
         raise ValueError("OpenAI API Key missing.")
     try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        # AsyncOpenAIは内部に1つのhttpx.AsyncClientを持ち、全リクエストで接続を共有する
+        # RateLimitErrorなどはSDKが指数バックオフ（ジッター付き）で再試行する
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES)
     except AuthenticationError as e:
         raise
     except Exception as e:
         raise
 
     # Firestoreクライアントの初期化
+    # gRPCチャネル（接続プール）を再利用するため、リクエストごとに再生成しないこと
     try:
         db = firestore.Client()
     except DefaultCredentialsError as e:
@@ -83,30 +116,139 @@ def initialize_clients():
 try:
     initialize_clients()
 except Exception:
+    logger.exception("Failed to initialize clients")
     exit(1)
 
+# 最初のリクエストでTLS・gRPCの接続確立を待たないよう、起動時に軽い呼び出しで接続しておく
+async def warm_up_connections():
+    warm_ups = {
+        "Firestore": asyncio.to_thread(lambda: db.collection(CONVERSATION_COLLECTION).limit(1).get()),
+        "OpenAI": openai_client.models.retrieve(OPENAI_MODEL),
+        "LINE": async_line_bot_api.get_bot_info(),
+    }
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(*warm_ups.values(), return_exceptions=True),
+            timeout=WARM_UP_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Connection warm-up timed out")
+        return
+    for name, result in zip(warm_ups, results):
+        if isinstance(result, Exception):
+            # 起動は止めず、最初のリクエストで改めて接続する
+            logger.warning("Failed to warm up %s connection: %s", name, result)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """イベントループ上で非同期クライアントを生成し、終了時に接続を閉じる"""
+    global async_line_bot_api
+    # AsyncApiClient(aiohttp)は実行中のイベントループが必要なため、ここで生成する
+    async_api_client = AsyncApiClient(create_line_configuration())
+    async_line_bot_api = AsyncMessagingApi(async_api_client)
+    await warm_up_connections()
+    try:
+        yield
+    finally:
+        # 受付済みのイベント処理を終えてから接続を閉じる
+        while _background_tasks:
+            await asyncio.gather(*_background_tasks, return_exceptions=True)
+        async_line_bot_api = None
+        await async_api_client.close()
+        await openai_client.close()
+
+# レスポンスのJSONシリアライズには高速なorjsonを使う
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 # 定数
 RESET_COMMAND = "リセット"
+# OpenAIのプロンプトキャッシュが効くよう、全ユーザー共通の先頭部分には動的な値（日時・ユーザー名など）を含めないこと
 DEFAULT_SYSTEM_PROMPT = "あなたは親切なAIアシスタントです。ユーザーの質問に答えたり、会話を楽しんだりします。"
 CONVERSATION_COLLECTION = 'conversations'  # Firestoreのコレクション名
 MAX_HISTORY_PAIRS = 10  # 会話履歴の最大保存数（ユーザーとアシスタントのペア数）
+HISTORY_FIELD_PATHS = ['messages']  # 会話履歴の取得時に読み込むフィールド
 
 OPENAI_MODEL = "gpt-3.5-turbo"
 OPENAI_MAX_TOKENS = 200  # 応答の最大トークン数
 OPENAI_TEMPERATURE = 0.7  # 応答の温度（ランダム性の度合い）
+OPENAI_PROMPT_TOKEN_BUDGET = 1500  # OpenAIに送るプロンプト（システムプロンプト＋会話履歴）の最大トークン数（推定）
+TOKEN_COUNT_CACHE_MAXSIZE = 4096  # トークン数を記憶しておくメッセージ数
+LOADING_ANIMATION_SECONDS = 20  # 応答生成中に表示するローディングアニメーションの秒数（5の倍数、最大60）
+
+OPENAI_BATCH_COMPLETION_WINDOW = "24h"  # Batch APIの完了期限
+OPENAI_BATCH_POLL_INTERVAL = 60  # Batch APIの状態確認の間隔（秒）
+
+# トークン数の推定に使うエンコーダ（起動時に一度だけ読み込む）
+# Dockerイメージではビルド時に TIKTOKEN_CACHE_DIR へ取得済みのため、起動時にダウンロードは発生しない
+# （OPENAI_MODELを変更してエンコーディングが変わる場合は、Dockerfileの取得対象も合わせること）
+try:
+    token_encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+except Exception:
+    token_encoding = None # 読み込めない場合は文字数で推定する
+
+# メッセージのトークン数を推定する関数
+# 同じ履歴のメッセージは毎回送り直されるため、結果を記憶して再エンコードを避ける
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_MAXSIZE)
+def count_tokens(text: str) -> int:
+    if token_encoding is None:
+        return len(text)
+    return len(token_encoding.encode(text))
+
+SYSTEM_PROMPT_TOKENS = count_tokens(DEFAULT_SYSTEM_PROMPT)
+OPENAI_HISTORY_TOKEN_BUDGET = OPENAI_PROMPT_TOKEN_BUDGET - SYSTEM_PROMPT_TOKENS  # 会話履歴に使えるトークン数
+
+REPLY_CACHE_MAXSIZE = 5000  # 定型応答キャッシュの最大件数
+REPLY_CACHE_TTL = 3600  # 定型応答キャッシュの有効期間（秒）
+REPLY_CACHE_MAX_LENGTH = 20  # 定型応答キャッシュの対象とするメッセージの最大文字数
+
+# 挨拶などの短いメッセージに対する応答のキャッシュ（メッセージのハッシュ -> 応答）
+# 会話の文脈に依存しないよう、履歴のない状態での応答のみを保存・利用する
+reply_cache = TTLCache(maxsize=REPLY_CACHE_MAXSIZE, ttl=REPLY_CACHE_TTL)
+
+# 同時に多数のメッセージを受けてもOpenAIへのリクエストを並行させつつ、同時数を制限する
+openai_semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+HISTORY_CACHE_MAXSIZE = 10_000  # 会話履歴キャッシュの最大ユーザー数
+HISTORY_CACHE_TTL = 60  # 会話履歴キャッシュの有効期間（秒）
+HISTORY_TRIM_SLACK = 10  # 上限を超えて追記を許す件数（超えた時点でまとめて切り詰める）
+
+# 会話履歴のプロセス内キャッシュ（user_id -> messages）
+# Firestore操作はスレッドから呼ばれるため、ロックで保護する
+_history_cache = TTLCache(maxsize=HISTORY_CACHE_MAXSIZE, ttl=HISTORY_CACHE_TTL)
+_history_cache_lock = threading.Lock()
+
+# 実行中のバックグラウンドタスク（GCで破棄されないよう参照を保持する）
+_background_tasks = set()
+
+# ユーザーごとのロック（履歴の読み込みからキャッシュ更新までを1ターンずつ直列に行う）
+# 使用中のロックのみ保持し、誰も参照しなくなれば自動的に破棄される
+_user_locks = weakref.WeakValueDictionary()
+
+# ユーザーごとの最後に登録された会話履歴の書き込み（user_id -> Task）
+# 同じユーザーの書き込みは前の書き込みの完了を待ってから、登録順に実行する
+_pending_history_writes = {}
 
 # Firestore操作関数
-def get_conversation_history(user_id: str) -> list:
+def get_stored_messages(user_id: str) -> list | None:
+    """Firestoreに保存されている履歴をそのまま返す（取得できなかった場合はNone）"""
     if not db:
         return []
+    with _history_cache_lock:
+        cached = _history_cache.get(user_id)
+    if cached is not None:
+        # 呼び出し側で追記されてもキャッシュが変わらないようコピーを返す
+        return list(cached)
     try:
         doc_ref = db.collection(CONVERSATION_COLLECTION).document(user_id)
-        doc = doc_ref.get()
+        # messagesフィールドのみを取得し、ドキュメントの他のフィールドは転送しない
+        doc = doc_ref.get(field_paths=HISTORY_FIELD_PATHS)
         if doc.exists:
             history = doc.to_dict().get('messages', [])
             if isinstance(history, list):
-                 # 履歴の長さを制限（最新の MAX_HISTORY_PAIRS * 2 件）
-                return history[-(MAX_HISTORY_PAIRS * 2):]
+                # 読み込み中に新しい履歴がキャッシュされていれば、そちらを優先する
+                with _history_cache_lock:
+                    _history_cache.setdefault(user_id, list(history))
+                return history
             else:
                 reset_conversation_history(user_id)
                 return []
@@ -114,24 +256,135 @@ def get_conversation_history(user_id: str) -> list:
             # ドキュメントが存在しない場合は空の履歴
             return []
     except Exception as e:
-        return [] # エラー時も空の履歴を返す
-    
-# 会話履歴をFirestoreに保存する関数
-def save_conversation_history(user_id: str, history: list):
+        logger.exception("Error loading conversation history: user_id=%s", user_id)
+        return None
+
+# 履歴の長さを制限する関数（最新の MAX_HISTORY_PAIRS * 2 件）
+def get_recent_history(history: list | None) -> list:
+    return (history or [])[-(MAX_HISTORY_PAIRS * 2):] # 履歴を取得できなかった場合は空の履歴
+
+# 会話履歴がキャッシュにあるかを返す関数
+def is_history_cached(user_id: str) -> bool:
+    with _history_cache_lock:
+        return user_id in _history_cache
+
+# 会話履歴をキャッシュに反映する関数
+def cache_conversation_history(user_id: str, history: list):
+    with _history_cache_lock:
+        _history_cache[user_id] = list(history)
+
+# トランザクション内で最新の履歴を読み込み、新しいメッセージを追記して書き戻す
+@firestore.transactional
+def _append_messages_in_transaction(transaction, doc_ref, new_messages: list) -> list:
+    doc = doc_ref.get(field_paths=HISTORY_FIELD_PATHS, transaction=transaction)
+    history = doc.to_dict().get('messages', []) if doc.exists else []
+    if not isinstance(history, list):
+        history = []
+    # 保存前に履歴の長さを制限
+    limited_history = get_recent_history(history + new_messages)
+    transaction.set(doc_ref, {'messages': limited_history}, merge=True)
+    return limited_history
+
+# キャッシュが想定した内容のままの場合にだけ、書き込み結果で置き換える
+def replace_cached_history(user_id: str, expected: list, history: list):
+    """書き込み中にイベントループ側でより新しい履歴がキャッシュされていれば、それを上書きしない"""
+    with _history_cache_lock:
+        if _history_cache.get(user_id) == expected:
+            _history_cache[user_id] = list(history)
+
+# 会話履歴にメッセージを追記する関数
+def append_messages(user_id: str, new_messages: list, stored: list | None = None) -> list:
+    """
+    通常はArrayUnionで新しいメッセージだけを送信する。
+    各メッセージは一意のidを持つため、内容が同じでもArrayUnionで重複として除外されることはない。
+    保存済みの履歴が不明な場合、または上限を超える場合は、トランザクションで切り詰めて書き直す。
+    """
     if not db:
-        return
+        return []
     try:
         doc_ref = db.collection(CONVERSATION_COLLECTION).document(user_id)
-        # 保存前に履歴の長さを制限
-        limited_history = history[-(MAX_HISTORY_PAIRS * 2):]
-        doc_ref.set({'messages': limited_history}, merge=True)
+        can_append = (
+            stored is not None
+            and len(stored) + len(new_messages) <= MAX_HISTORY_PAIRS * 2 + HISTORY_TRIM_SLACK
+        )
+        if can_append:
+            history = stored + new_messages
+            try:
+                doc_ref.update({'messages': firestore.ArrayUnion(new_messages)})
+            except NotFound:
+                # 初回のユーザーはドキュメントが存在しないため新規作成する
+                history = list(new_messages)
+                doc_ref.set({'messages': history}, merge=True)
+        else:
+            history = _append_messages_in_transaction(db.transaction(), doc_ref, new_messages)
     except Exception as e:
+        with _history_cache_lock:
+            _history_cache.pop(user_id, None)
         raise
+    # handle_messageが stored + new_messages を先にキャッシュしているため、それが残っている場合のみ更新する
+    if stored is not None:
+        replace_cached_history(user_id, stored + new_messages, history)
+    return history
+
+# ユーザーとアシスタントのメッセージを会話履歴に追記する関数
+def append_and_get_history(user_id: str, user_msg: dict, assistant_msg: dict, stored: list | None = None) -> list:
+    return append_messages(user_id, [user_msg, assistant_msg], stored)
+
+# 応答が得られなかった場合にユーザーのメッセージのみを追記する関数
+def append_user_message(user_id: str, user_msg: dict, stored: list | None = None):
+    append_messages(user_id, [user_msg], stored)
+
+# コルーチンをバックグラウンドタスクとして登録する
+def create_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+# 会話履歴の書き込みを、同じユーザーの保留中の書き込みの後に実行するよう登録する
+def schedule_history_write(user_id: str, func, *args) -> asyncio.Task:
+    previous = _pending_history_writes.get(user_id)
+
+    async def write():
+        if previous is not None:
+            # 前の書き込みの成否にかかわらず完了を待つ（失敗はそのタスク側でログに出る）
+            await asyncio.wait({previous})
+        return await asyncio.to_thread(func, *args)
+
+    task = create_background_task(write())
+    _pending_history_writes[user_id] = task
+    task.add_done_callback(functools.partial(_on_history_write_done, user_id))
+    return task
+
+def _on_history_write_done(user_id: str, task: asyncio.Task):
+    if _pending_history_writes.get(user_id) is task:
+        del _pending_history_writes[user_id]
+
+# ユーザーごとのロックを返す
+def get_user_lock(user_id: str) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
+
+# 保留中の会話履歴の書き込みが終わるまで待つ
+async def wait_for_history_writes(user_id: str):
+    pending = _pending_history_writes.get(user_id)
+    if pending is not None:
+        await asyncio.wait({pending})
+
+def _on_background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Error in background task", exc_info=task.exception())
 
 # 会話履歴をリセットする関数
 def reset_conversation_history(user_id: str):
     if not db:
         return
+    with _history_cache_lock:
+        _history_cache.pop(user_id, None)
     try:
         doc_ref = db.collection(CONVERSATION_COLLECTION).document(user_id)
         # ドキュメント自体は残し、messagesフィールドを空にする（他の情報があれば保持される）
@@ -139,129 +392,270 @@ def reset_conversation_history(user_id: str):
     except Exception as e:
         raise
 
+# 会話履歴を新しい順にたどり、トークン数の上限に収まる分だけ残す関数
+def trim_history_by_tokens(history: list, budget: int = OPENAI_HISTORY_TOKEN_BUDGET) -> list:
+    total = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        total += count_tokens(history[i]["content"])
+        # 最新のメッセージは上限を超えても必ず送る
+        if total > budget and i < len(history) - 1:
+            break
+        start = i
+    return history[start:]
+
+# OpenAI APIに渡すメッセージリストを作成する関数
+def build_openai_messages(history: list) -> list:
+    """
+    先頭を常に同一の内容にして、OpenAI側のプロンプトキャッシュを効かせる。
+    共通のシステムプロンプト → 会話履歴 の順に並べる。
+    """
+    messages = [{"role": "system", "content": DEFAULT_SYSTEM_PROMPT}]
+    # 履歴はrole・content以外のフィールドを含めず、件数に加えてトークン数でも制限する
+    messages += [
+        {"role": message["role"], "content": message["content"]}
+        for message in trim_history_by_tokens(history)
+    ]
+    return messages
+
+# 定型応答キャッシュのキーを返す関数（キャッシュの対象外ならNone）
+def get_reply_cache_key(history: list) -> bytes | None:
+    if len(history) != 1 or history[0]["role"] != "user":
+        return None
+    text = history[0]["content"].strip().lower()
+    if not text or len(text) > REPLY_CACHE_MAX_LENGTH:
+        return None
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
 # OpenAI API呼び出し関数
-def get_openai_response(history: list) -> str | None:
+async def get_openai_response(history: list) -> str | None:
     if not openai_client:
         return "申し訳ありません、AIとの接続に問題が発生しました。"
 
+    # 履歴のない短いメッセージは、同じ内容への過去の応答があればOpenAIを呼ばずに返す
+    cache_key = get_reply_cache_key(history)
+    if cache_key is not None:
+        cached_reply = reply_cache.get(cache_key)
+        if cached_reply is not None:
+            return cached_reply
+
     # OpenAI APIに渡すメッセージリストを作成
-    messages = [{"role": "system", "content": DEFAULT_SYSTEM_PROMPT}] + history
+    messages = build_openai_messages(history)
 
     try:
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            max_tokens=OPENAI_MAX_TOKENS,
-            temperature=OPENAI_TEMPERATURE,
-            # stream=False # ストリーミング応答を使わない場合
-        )
-        ai_message = response.choices[0].message.content.strip()
+        async with openai_semaphore:
+            stream = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=OPENAI_MAX_TOKENS,
+                temperature=OPENAI_TEMPERATURE,
+                stream=True,
+            )
+            chunks = []
+            async for chunk in stream:
+                if chunk.choices:
+                    chunks.append(chunk.choices[0].delta.content or "")
+        ai_message = "".join(chunks).strip()
+        if cache_key is not None and ai_message:
+            reply_cache[cache_key] = ai_message
         return ai_message
     except AuthenticationError as e:
+        logger.error("OpenAI authentication failed: %s", e)
         return "AIサービスの認証に失敗しました。設定を確認してください。"
     except RateLimitError as e:
+        logger.warning("OpenAI rate limit exceeded: %s", e)
         return "AIサービスの利用制限に達しました。しばらくしてからお試しください。"
     except APIError as e: # OpenAIサーバー側のエラーなど
+        logger.warning("OpenAI API error: %s", e)
         return f"AIサービスでエラーが発生しました (エラーコード: {e.status_code})。"
     except Exception as e: # その他の予期せぬエラー
+        logger.exception("Unexpected error generating OpenAI response")
         return "申し訳ありません、AIの応答生成中に予期せぬエラーが発生しました。"
 
-def create_rich_menu() -> str:
+# Batch API（即時応答が不要な処理向け。対話の応答には get_openai_response を使う）
+async def submit_batch(prompts: list[dict]) -> str:
     """
-    リッチメニューを作成してIDを返す
+    会話履歴のリストをBatch APIに投入してバッチIDを返す
+    prompts: [{"custom_id": 結果を識別するID, "messages": 会話履歴}, ...]
     """
-    rich_menu = RichMenuRequest(
-        size=RichMenuSize(width=2500, height=1686),
-        selected=False,  # ユーザーに最初から選択状態にするならTrue
-        name="デフォルトメニュー",               # 管理画面上での名前
-        chat_bar_text="メニューを開く",  # トークルーム下部のテキスト
-        areas=[
-            # 左半分タップで「ヘルプ」テキストを送る
-            RichMenuArea(
-                bounds=RichMenuBounds(x=0, y=0, width=1250, height=1686),
-                action=MessageAction(label="リセット", text="リセット")
-            ),
-            # 右半分タップで「問い合わせ」を返信
-            RichMenuArea(
-                bounds=RichMenuBounds(x=1250, y=0, width=1250, height=1686),
-                action=MessageAction(label="こんにちは", text="こんにちは")
-            ),
-        ]
+    lines = []
+    for prompt in prompts:
+        request = {
+            "custom_id": prompt["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": OPENAI_MODEL,
+                "messages": build_openai_messages(prompt["messages"]),
+                "max_tokens": OPENAI_MAX_TOKENS,
+                "temperature": OPENAI_TEMPERATURE,
+            },
+        }
+        lines.append(json.dumps(request, ensure_ascii=False))
+
+    batch_file = await openai_client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
     )
-    resp = line_bot_api.create_rich_menu(rich_menu)
-    return resp.rich_menu_id
-
-
-def upload_rich_menu_image(rich_menu_id: str, image_path: str):
-    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-    with ApiClient(configuration) as api_client:
-        messaging_api_blob = MessagingApiBlob(api_client)
-        with open(image_path, "rb") as img_file:
-            image_data = img_file.read()
-            messaging_api_blob.set_rich_menu_image(
-                rich_menu_id=rich_menu_id,
-                body=image_data,
-                _headers={'Content-Type': 'image/jpeg'}
-            )
-
-def link_rich_menu_to_user(user_id: str, rich_menu_id: str):
-    line_bot_api.link_rich_menu_to_user(user_id, rich_menu_id)
-
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=OPENAI_BATCH_COMPLETION_WINDOW,
+    )
+    return batch.id
+
+async def wait_for_batch(batch_id: str) -> dict[str, str]:
+    """バッチの完了を待ち、custom_idごとの応答テキストを返す"""
+    while True:
+        batch = await openai_client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            break
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} ended with status: {batch.status}")
+        await asyncio.sleep(OPENAI_BATCH_POLL_INTERVAL)
+
+    if not batch.output_file_id:
+        return {}
+    output = await openai_client.files.content(batch.output_file_id)
+    results = {}
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            continue # 失敗したリクエストは結果に含めない
+        results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+    return results
 
 @app.post("/callback")
 async def callback(request: Request):
-    signature = request.headers.get('X-Line-Signature')
+    # ヘッダーは大文字小文字を区別しない。ボディは生のバイト列のまま署名検証・JSON解析に使う
+    signature = request.headers.get('x-line-signature')
     body = await request.body()
-    body_str = body.decode('utf-8')
 
-    try:
-        handler.handle(body_str, signature)
-    except Exception as e:
-        raise
+    if not verify_signature(body, signature):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid signature")
+
+    # 署名検証後すぐに200を返し、OpenAI・Firestoreを含む処理はバックグラウンドで行う
+    create_background_task(process_events(body))
 
     return 'OK'
 
+# X-Line-Signature（リクエストボディのHMAC-SHA256をBase64エンコードしたもの）を検証する
+def verify_signature(body: bytes, signature: str | None) -> bool:
+    if not signature:
+        return False
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode('utf-8'))
+
+# Webhookのイベントを解析し、ハンドラへ渡す
+async def process_events(body: bytes):
+    # 同じ送信元のイベントは受信順に、異なる送信元のイベントは並行して処理する
+    events_by_source = {}
+    for event_json in json.loads(body).get('events', []):
+        try:
+            event = Event.from_dict(event_json)
+        except ValueError:
+            continue # 未対応のイベント種別は無視する
+        source_id = getattr(event.source, 'user_id', None) if event.source else None
+        events_by_source.setdefault(source_id, []).append(event)
+
+    results = await asyncio.gather(
+        *(dispatch_events_in_order(events) for events in events_by_source.values()),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+async def dispatch_events_in_order(events: list):
+    for event in events:
+        await dispatch_event(event)
+
+# イベント種別ごとに非同期ハンドラへ振り分ける
+async def dispatch_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        await handle_message(event)
+    elif isinstance(event, FollowEvent):
+        await handle_follow(event)
+    elif isinstance(event, UnfollowEvent):
+        await handle_unfollow(event)
+
 # テキストメッセージイベントの処理
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event: MessageEvent):
+async def handle_message(event: MessageEvent):
     user_id = event.source.user_id
     user_message_text = event.message.text
     reply_token = event.reply_token
-
-    # リセットコマンドの処理
-    if user_message_text.strip().lower() == RESET_COMMAND.lower():
-        reset_conversation_history(user_id)
-        reply_text = "会話履歴をリセットしました。新しい会話を始めましょう！"
-
-    # 通常の会話処理
-    else:
-        history = get_conversation_history(user_id)
-        history.append({"role": "user", "content": user_message_text})
-        ai_response = get_openai_response(history)
-        if ai_response:
-            history.append({"role": "assistant", "content": ai_response})
-            save_conversation_history(user_id, history)
-            reply_text = ai_response
+    loading_task = None
+
+    # 同じユーザーのターンは、履歴の読み込みからキャッシュ更新まで1つずつ処理する
+    # （リセットや別のターンの結果が、並行するターンのキャッシュ更新で上書きされないようにする）
+    async with get_user_lock(user_id):
+        # リセットコマンドの処理
+        if user_message_text.strip().lower() == RESET_COMMAND.lower():
+            # 保留中の追記の後に実行し、リセットが古い書き込みで上書きされないようにする
+            await schedule_history_write(user_id, reset_conversation_history, user_id)
+            reply_text = "会話履歴をリセットしました。新しい会話を始めましょう！"
+
+        # 通常の会話処理
         else:
-            reply_text = "申し訳ありません、現在応答を生成できません。"
+            # 応答の生成を待つ間、トーク画面にローディングアニメーションを表示する（1対1のトークのみ）
+            if isinstance(event.source, UserSource):
+                loading_task = create_background_task(show_loading_animation(user_id))
+            # キャッシュがない場合はFirestoreから読むため、保留中の書き込みの反映を待つ
+            if not is_history_cached(user_id):
+                await wait_for_history_writes(user_id)
+            # Firestoreの同期I/Oはスレッドに逃がし、イベントループをブロックしない
+            stored = await asyncio.to_thread(get_stored_messages, user_id)
+            history = get_recent_history(stored)
+            # 保存するメッセージには一意のidを付ける（OpenAIにはrole・contentのみを送る）
+            user_msg = {"role": "user", "content": user_message_text, "id": event.message.id}
+            history.append(user_msg)
+            ai_response = await get_openai_response(history)
+            if ai_response:
+                assistant_msg = {"role": "assistant", "content": ai_response, "id": uuid.uuid4().hex}
+                history.append(assistant_msg)
+                # 次の発言に備えて先にキャッシュを更新し、保存は応答をブロックしないようバックグラウンドで行う
+                if stored is not None:
+                    cache_conversation_history(user_id, stored + [user_msg, assistant_msg])
+                schedule_history_write(user_id, append_and_get_history, user_id, user_msg, assistant_msg, stored)
+                reply_text = ai_response
+            else:
+                if stored is not None:
+                    cache_conversation_history(user_id, stored + [user_msg])
+                schedule_history_write(user_id, append_user_message, user_id, user_msg, stored)
+                reply_text = "申し訳ありません、現在応答を生成できません。"
 
     # ユーザーに応答を送信
-    if not line_bot_api:
+    if not async_line_bot_api:
         return # 返信できない場合はここで終了
+
+    # ローディング表示の要求が応答より後に届くと、応答後もアニメーションが残るため完了を待つ
+    if loading_task is not None:
+        await asyncio.wait({loading_task})
     
     try:
-        line_bot_api.reply_message(
+        await async_line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=reply_token,
                 messages=[TextMessage(text=reply_text)]
             )
         )
     except Exception as e:
-        print(f"Error sending reply: {e}")
+        logger.exception("Error sending reply: user_id=%s", user_id)
+
+# ローディングアニメーションを表示する関数（応答メッセージを送信すると自動的に消える）
+async def show_loading_animation(user_id: str):
+    if not async_line_bot_api:
+        return
+    try:
+        await async_line_bot_api.show_loading_animation(
+            ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=LOADING_ANIMATION_SECONDS)
+        )
+    except Exception as e:
+        logger.exception("Error showing loading animation: user_id=%s", user_id)
 
 # フォローイベントの処理
-@handler.add(FollowEvent)
-def handle_follow(event: FollowEvent):
+async def handle_follow(event: FollowEvent):
     user_id = event.source.user_id
     reply_token = event.reply_token
 
@@ -269,10 +663,10 @@ def handle_follow(event: FollowEvent):
         text=f"初めまして！\nGPTくんです！\n\n会話を記憶するけど、「{RESET_COMMAND}」と入力すると会話履歴をリセットするよ！"
     )
 
-    if not line_bot_api:
+    if not async_line_bot_api:
         return
     try:
-        line_bot_api.reply_message(
+        await async_line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=reply_token,
                 messages=[welcome_message]
@@ -282,8 +676,7 @@ def handle_follow(event: FollowEvent):
         raise
 
 # アンフォローイベントの処理
-@handler.add(UnfollowEvent)
-def handle_unfollow(event: UnfollowEvent):
+async def handle_unfollow(event: UnfollowEvent):
     user_id = event.source.user_id
 
 # ルートエンドポイント（動作確認用）
@@ -294,13 +687,11 @@ async def root():
 
 
 if __name__ == "__main__":
-    rm_id = create_rich_menu()
-    upload_rich_menu_image(rm_id, "./app/richmenu.jpg")
-    print('richmenu_id:', rm_id)
-    line_bot_api.set_default_rich_menu(rm_id)
-    
+    # リッチメニューの設定は scripts/setup_richmenu.py で一度だけ行う
     port = int(os.getenv("PORT", 8000))
-    if handler and line_bot_api and openai_client and db:
-        uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    # ワーカー数（既定はCPUコア数 * 2 + 1）。各ワーカーはimport時にクライアントを個別に初期化する
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    if openai_client and db:
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, reload=False)
     else:
         exit(1)
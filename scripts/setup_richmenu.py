@@ -0,0 +1,78 @@
+"""リッチメニューを作成・画像アップロードし、デフォルトに設定する管理用スクリプト
+
+サーバー起動（ワーカー）ごとに実行されないよう、デプロイ時に一度だけ手動で実行する。
+    python scripts/setup_richmenu.py
+"""
+import os
+from dotenv import load_dotenv
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    MessagingApi,
+    MessagingApiBlob,
+)
+from linebot.v3.messaging.models import (
+    RichMenuRequest,
+    RichMenuSize,
+    RichMenuArea,
+    RichMenuBounds,
+    MessageAction,
+)
+
+load_dotenv()
+
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+RICH_MENU_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "richmenu.jpg")
+
+# Messaging APIとBlob APIで同じApiClient（接続プール）を共有する
+api_client = ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN))
+line_bot_api = MessagingApi(api_client)
+line_bot_blob_api = MessagingApiBlob(api_client)
+
+
+def create_rich_menu() -> str:
+    """
+    リッチメニューを作成してIDを返す
+    """
+    rich_menu = RichMenuRequest(
+        size=RichMenuSize(width=2500, height=1686),
+        selected=False,  # ユーザーに最初から選択状態にするならTrue
+        name="デフォルトメニュー",               # 管理画面上での名前
+        chat_bar_text="メニューを開く",  # トークルーム下部のテキスト
+        areas=[
+            # 左半分タップで「ヘルプ」テキストを送る
+            RichMenuArea(
+                bounds=RichMenuBounds(x=0, y=0, width=1250, height=1686),
+                action=MessageAction(label="リセット", text="リセット")
+            ),
+            # 右半分タップで「問い合わせ」を返信
+            RichMenuArea(
+                bounds=RichMenuBounds(x=1250, y=0, width=1250, height=1686),
+                action=MessageAction(label="こんにちは", text="こんにちは")
+            ),
+        ]
+    )
+    resp = line_bot_api.create_rich_menu(rich_menu)
+    return resp.rich_menu_id
+
+
+def upload_rich_menu_image(rich_menu_id: str, image_path: str):
+    with open(image_path, "rb") as img_file:
+        image_data = img_file.read()
+    line_bot_blob_api.set_rich_menu_image(
+        rich_menu_id=rich_menu_id,
+        body=image_data,
+        _headers={'Content-Type': 'image/jpeg'}
+    )
+
+def link_rich_menu_to_user(user_id: str, rich_menu_id: str):
+    line_bot_api.link_rich_menu_to_user(user_id, rich_menu_id)
+
+
+if __name__ == "__main__":
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        raise SystemExit("LINE_CHANNEL_ACCESS_TOKEN is missing.")
+    rm_id = create_rich_menu()
+    upload_rich_menu_image(rm_id, RICH_MENU_IMAGE_PATH)
+    print('richmenu_id:', rm_id)
+    line_bot_api.set_default_rich_menu(rm_id)